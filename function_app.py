@@ -1,148 +1,196 @@
 import azure.functions as func
 import logging
-import json
 import os
-import threading
-from collections import deque
-from datetime import datetime
-from azure.communication.email import EmailClient
+import msgspec
+import orjson
+import gzip
+import time
+from azure.communication.email.aio import EmailClient
 
 # ================= GLOBAL STATE =================
 # Note: In a Consumption plan, this state is cleared if the app scales to zero.
 # It works best on an App Service Plan (Always On) or with frequent polling.
 
-history = deque(maxlen=100)
+# History is kept as parallel series (one entry per /collect) so /plot can
+# serialize each one directly without walking per-record objects.
+# The two boolean series are sliding bitmasks: bit 0 is the newest reading.
+HISTORY_SIZE = 100
+HISTORY_MASK = (1 << HISTORY_SIZE) - 1
+
+# Timestamps (epoch seconds) live in a preallocated ring buffer: history_head
+# is the next slot to write, history_len counts filled slots.
+history_timestamps = [0] * HISTORY_SIZE
+history_head = 0
+history_len = 0
+history_status_bits = 0     # OPEN=1, CLOSED=0
+history_motion_bits = 0     # True=1, False=0
+history_version = 0     # Bumped on every append; keys the /plot cache
 mute_next_response = False
 
-# Track previous states for edge detection
-last_motion_state = False       
-last_vault_status = "CLOSED"
+# Track previous (motion, vault status) for edge detection
+last_state = (False, "CLOSED")
+
+# NO LOCK: all handlers are coroutines on the worker's single event loop, so
+# shared state is only ever touched by one request at a time as long as no
+# await sits between reading and writing it.
+
+# Rendered /plot page (plain and gzipped), reused until history changes
+plot_cache = {"version": -1, "html": b"", "html_gz": b""}
 
-# LOCK for thread safety (Python Functions use a thread pool for sync requests)
-data_lock = threading.Lock()
+log = logging.getLogger(__name__)
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
 # ================= HELPER: SEND EMAIL (ACS) =================
-def send_acs_email(subject, body):
-    """Sends an email using Azure Communication Services."""
-    connection_string = os.environ.get("COMMUNICATION_CONNECTION_STRING")
-    sender_address = os.environ.get("SENDER_ADDRESS")
-    recipient_address = os.environ.get("RECIPIENT_ADDRESS")
+# Read config and build the client once per worker, so every alert reuses the
+# same HTTP pipeline (and its keep-alive connections) instead of rebuilding it.
+ACS_CONNECTION_STRING = os.environ.get("COMMUNICATION_CONNECTION_STRING")
+ACS_SENDER_ADDRESS = os.environ.get("SENDER_ADDRESS")
+ACS_RECIPIENT_ADDRESS = os.environ.get("RECIPIENT_ADDRESS")
+ACS_ENABLED = all([ACS_CONNECTION_STRING, ACS_SENDER_ADDRESS, ACS_RECIPIENT_ADDRESS])
+
+if ACS_ENABLED:
+    email_client = EmailClient.from_connection_string(ACS_CONNECTION_STRING)
+else:
+    email_client = None
+    log.warning("Missing Azure Communication Services configuration. Email alerts are disabled.")
 
-    if not connection_string or not sender_address or not recipient_address:
-        logging.error("Missing Azure Communication Services configuration.")
+async def send_acs_email(subject, body):
+    """Sends an email using Azure Communication Services."""
+    if not ACS_ENABLED:
         return
 
-    try:
-        client = EmailClient.from_connection_string(connection_string)
-
-        message = {
-            "senderAddress": sender_address,
-            "recipients":  {
-                "to": [{"address": recipient_address}]
-            },
-            "content": {
-                "subject": f"[VaultAlert] {subject}",
-                "plainText": body
-            }
+    message = {
+        "senderAddress": ACS_SENDER_ADDRESS,
+        "recipients":  {
+            "to": [{"address": ACS_RECIPIENT_ADDRESS}]
+        },
+        "content": {
+            "subject": f"[VaultAlert] {subject}",
+            "plainText": body
         }
+    }
 
-        poller = client.begin_send(message)
-        result = poller.result()
-        logging.info(f"Email sent successfully. Message ID: {result['messageId']}")
-        
-    except Exception as e:
-        logging.error(f"Failed to send email via ACS: {e}")
+    # Errors propagate so the queue trigger retries the message
+    poller = await email_client.begin_send(message)
+    result = await poller.result()
+    log.info("Email sent successfully. Message ID: %s", result["messageId"])
+
+# ================= HELPER: FORMAT TIMESTAMP =================
+def format_timestamp(ts):
+    """Formats stored epoch seconds as local time for display."""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+
+# ================= HELPER: ALERT MESSAGE =================
+# /collect only enqueues alerts to a Storage Queue; the queue-triggered
+# send_alert function below does the ACS call, with platform retries/poison queue.
+ALERT_QUEUE_NAME = "vault-alerts"
+ALERT_QUEUE_CONNECTION = "AzureWebJobsStorage"
+
+def build_alert_message(triggers, timestamp, light, status):
+    """Builds the queue message (JSON with email subject and body) for an alert."""
+    body = (
+        f"Security Alert Triggered!\n\n"
+        f"Events: {', '.join(triggers)}\n"
+        f"Time: {format_timestamp(timestamp)}\n"
+        f"Light Level: {light}\n"
+        f"Status: {status}\n"
+    )
+    return orjson.dumps({"subject": " | ".join(triggers), "body": body}).decode()
+
+# ================= SCHEMA: DEVICE READING =================
+class Reading(msgspec.Struct):
+    """Telemetry posted by the device; unknown fields (e.g. alarm_active) are ignored."""
+    motion_detected: bool = False
+    vault_status: str = "CLOSED"
+    light_level: int = 0
 
 # ================= ENDPOINT 1: COLLECT =================
+# /collect only ever answers with these bodies, so build the responses once.
+# The Functions worker only reads a returned HttpResponse, so sharing is safe.
+RESPONSE_OK = func.HttpResponse("true", status_code=200)
+RESPONSE_MUTE = func.HttpResponse("false", status_code=200)
+RESPONSE_INVALID_JSON = func.HttpResponse("Invalid JSON", status_code=400)
+
 @app.route(route="collect", auth_level=func.AuthLevel.ANONYMOUS)
-def collect_data(req: func.HttpRequest) -> func.HttpResponse:
-    global mute_next_response, last_motion_state, last_vault_status
+@app.queue_output(arg_name="msg", queue_name=ALERT_QUEUE_NAME, connection=ALERT_QUEUE_CONNECTION)
+async def collect_data(req: func.HttpRequest, msg: func.Out[str]) -> func.HttpResponse:
+    global mute_next_response, last_state, history_version
+    global history_status_bits, history_motion_bits, history_head, history_len
 
     try:
         # 1. Parse Data
-        req_body = req.get_json()
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # Decode and validate in one pass; bad JSON or field types raise DecodeError
+        reading = msgspec.json.decode(req.get_body(), type=Reading)
+        current_motion = reading.motion_detected
+        current_status = reading.vault_status
+        current_light = reading.light_level
+        timestamp = int(time.time())  # Formatted only when displayed
         
-        # Local variables to determine actions AFTER releasing the lock
+        # Local variables to determine actions AFTER updating shared state
         should_send_email = False
         email_triggers = []
-        respond_with_mute = False
         
         # 2. CRITICAL SECTION: Access and modify shared state
-        with data_lock:
-            # Store Data
-            record = {
-                "timestamp": timestamp,
-                "data": req_body
-            }
-            history.append(record)
-            
-            # Logic Extraction
-            current_motion = req_body.get("motion_detected", False)
-            current_status = req_body.get("vault_status", "CLOSED")
-            current_light = req_body.get("light_level", 0)
-
-            # Edge Detection Logic
-            # Trigger if motion goes False -> True
-            if current_motion and not last_motion_state:
-                email_triggers.append("Motion Detected")
-
-            # Trigger if status goes CLOSED -> OPEN
-            if current_status == "OPEN" and last_vault_status == "CLOSED":
-                email_triggers.append("Vault Opened")
-
-            # Update state for next comparison
-            last_motion_state = current_motion
-            last_vault_status = current_status
-            
-            # Decide if we need to email
-            if email_triggers:
-                should_send_email = True
-
-            # Handle Response (Mute Logic)
-            # We check and reset the flag inside the lock to be atomic
-            if mute_next_response:
-                respond_with_mute = True
-                mute_next_response = False  # Reset flag immediately
-
-        # 3. NON-CRITICAL SECTION: Network I/O (Email)
-        # We perform this OUTSIDE the lock so we don't block other requests
+        # No await from here to step 3, so this runs atomically on the event loop
+
+        # Store only the fields /plot needs, not the raw request body
+        history_timestamps[history_head] = timestamp
+        history_head = (history_head + 1) % HISTORY_SIZE
+        history_len = min(history_len + 1, HISTORY_SIZE)
+        history_status_bits = ((history_status_bits << 1) | (current_status == "OPEN")) & HISTORY_MASK
+        history_motion_bits = ((history_motion_bits << 1) | current_motion) & HISTORY_MASK
+        history_version += 1
+
+        # Edge Detection Logic
+        last_motion_state, last_vault_status = last_state
+
+        # Trigger if motion goes False -> True
+        if current_motion and not last_motion_state:
+            email_triggers.append("Motion Detected")
+
+        # Trigger if status goes CLOSED -> OPEN
+        if current_status == "OPEN" and last_vault_status == "CLOSED":
+            email_triggers.append("Vault Opened")
+
+        # Update state for next comparison (single swap of the tuple)
+        last_state = (current_motion, current_status)
+        
+        # Decide if we need to email
+        if email_triggers:
+            should_send_email = True
+
+        # 3. NON-CRITICAL SECTION: Alert (Email)
+        # Enqueued for send_alert so ACS never blocks
+        # other requests or delays this response
         if should_send_email:
-            subject = " | ".join(email_triggers)
-            body = (
-                f"Security Alert Triggered!\n\n"
-                f"Events: {', '.join(email_triggers)}\n"
-                f"Time: {timestamp}\n"
-                f"Light Level: {current_light}\n"
-                f"Status: {current_status}\n"
-            )
-            logging.info(f"Trigger detected: {subject}. Sending email...")
-            send_acs_email(subject, body)
-
-        # 4. Return Response
-        if respond_with_mute:
-            logging.info("Sending MUTE command to device.")
-            return func.HttpResponse("false", status_code=200)
+            log.info("Trigger detected: %s. Queueing email...", email_triggers)
+            msg.set(build_alert_message(email_triggers, timestamp, current_light, current_status))
+
+        # 4. Return Response (Mute Logic)
+        # The mute flag is independent of the history/edge state above, so it
+        # is only touched here. Check and reset happen in the same step.
+        if mute_next_response:
+            mute_next_response = False  # Reset flag immediately
+            log.info("Sending MUTE command to device.")
+            return RESPONSE_MUTE
         
-        return func.HttpResponse("true", status_code=200)
+        return RESPONSE_OK
 
-    except ValueError:
-        return func.HttpResponse("Invalid JSON", status_code=400)
+    except msgspec.DecodeError:
+        return RESPONSE_INVALID_JSON
     except Exception as e:
-        logging.error(f"Error in collect: {e}")
+        log.exception("Error in collect")
         return func.HttpResponse(f"Server Error: {e}", status_code=500)
 
 # ================= ENDPOINT 2: MUTE =================
 @app.route(route="mute", auth_level=func.AuthLevel.ANONYMOUS)
-def mute_alarm(req: func.HttpRequest) -> func.HttpResponse:
+async def mute_alarm(req: func.HttpRequest) -> func.HttpResponse:
     global mute_next_response
     
-    with data_lock:
-        mute_next_response = True
-        
-    logging.info("Mute requested manually.")
+    mute_next_response = True
+
+    log.info("Mute requested manually.")
     
     return func.HttpResponse(
         "Mute command queued. The alarm will stop the next time the device reports in.",
@@ -150,48 +198,31 @@ def mute_alarm(req: func.HttpRequest) -> func.HttpResponse:
     )
 
 # ================= ENDPOINT 3: PLOT =================
-@app.route(route="plot", auth_level=func.AuthLevel.ANONYMOUS)
-def plot_data(req: func.HttpRequest) -> func.HttpResponse:
-    with data_lock:
-        data_snapshot = list(history)
-
-    # Extract time series
-    timestamps = []
-    statuses = []   # OPEN=1, CLOSED=0
-    motions = []    # True=1, False=0
-
-    for record in data_snapshot:
-        timestamps.append(record["timestamp"])
-
-        data = record["data"]
-        state = data.get("vault_status", "CLOSED")
-        motion = data.get("motion_detected", False)
-
-        statuses.append(1 if state == "OPEN" else 0)
-        motions.append(1 if motion else 0)
-
-    # Build HTML
-    html = f"""
+# Static page built once at import; only the three JSON arrays (labels,
+# vault status, motion) are %-filled per render. Literal % are escaped.
+# Kept as bytes so orjson output is embedded without a decode/encode trip.
+PLOT_TEMPLATE = b"""
     <!DOCTYPE html>
     <html>
     <head>
         <title>VaultAlert History Plot</title>
-        <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
+        <link rel="preload" href="https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.js" as="script" crossorigin>
+        <script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.js" crossorigin></script>
         <style>
-            body {{
+            body {
                 font-family: Arial, sans-serif;
                 padding: 20px;
                 background: #f6f6f6;
-            }}
-            #chart-container {{
-                width: 95%;
+            }
+            #chart-container {
+                width: 95%%;
                 max-width: 850px;
                 margin: auto;
                 background: white;
                 padding: 20px;
                 border-radius: 12px;
                 box-shadow: 0 3px 10px rgba(0,0,0,0.15);
-            }}
+            }
         </style>
     </head>
     <body>
@@ -203,18 +234,18 @@ def plot_data(req: func.HttpRequest) -> func.HttpResponse:
         </div>
 
         <script>
-            const labels = {json.dumps(timestamps)};
-            const vaultStatus = {json.dumps(statuses)};
-            const motionData = {json.dumps(motions)};
+            const labels = %s;
+            const vaultStatus = %s;
+            const motionData = %s;
 
             const ctx = document.getElementById('vaultChart').getContext('2d');
 
-            new Chart(ctx, {{
+            new Chart(ctx, {
                 type: 'line',
-                data: {{
+                data: {
                     labels: labels,
                     datasets: [
-                        {{
+                        {
                             label: 'Vault Status (1=OPEN, 0=CLOSED)',
                             data: vaultStatus,
                             borderWidth: 2,
@@ -222,8 +253,8 @@ def plot_data(req: func.HttpRequest) -> func.HttpResponse:
                             backgroundColor: 'rgba(255, 99, 132, 0.3)',
                             fill: false,
                             tension: 0.2
-                        }},
-                        {{
+                        },
+                        {
                             label: 'Motion Detected (1=YES, 0=NO)',
                             data: motionData,
                             borderWidth: 2,
@@ -231,30 +262,68 @@ def plot_data(req: func.HttpRequest) -> func.HttpResponse:
                             backgroundColor: 'rgba(54, 162, 235, 0.3)',
                             fill: false,
                             tension: 0.2
-                        }}
+                        }
                     ]
-                }},
-                options: {{
-                    scales: {{
-                        y: {{
+                },
+                options: {
+                    scales: {
+                        y: {
                             min: 0,
                             max: 1,
-                            ticks: {{
+                            ticks: {
                                 callback: (v) => v === 1 ? "1" : "0"
-                            }}
-                        }},
-                        x: {{
-                            ticks: {{
+                            }
+                        },
+                        x: {
+                            ticks: {
                                 maxRotation: 45,
                                 minRotation: 45
-                            }}
-                        }}
-                    }}
-                }}
-            }});
+                            }
+                        }
+                    }
+                }
+            });
         </script>
     </body>
     </html>
     """
 
-    return func.HttpResponse(html, mimetype="text/html")
+@app.route(route="plot", auth_level=func.AuthLevel.ANONYMOUS)
+async def plot_data(req: func.HttpRequest) -> func.HttpResponse:
+    version = history_version
+
+    # Re-render only when the cached page is stale
+    if plot_cache["version"] != version:
+        # Unroll the ring oldest-first; until it wraps, history_head == history_len
+        if history_len == HISTORY_SIZE:
+            timestamps = history_timestamps[history_head:] + history_timestamps[:history_head]
+        else:
+            timestamps = history_timestamps[:history_len]
+
+        # Unpack the bitmasks oldest-first to line up with the timestamps
+        shifts = range(history_len - 1, -1, -1)
+        html = PLOT_TEMPLATE % (
+            orjson.dumps([format_timestamp(ts) for ts in timestamps]),
+            orjson.dumps([(history_status_bits >> i) & 1 for i in shifts]),
+            orjson.dumps([(history_motion_bits >> i) & 1 for i in shifts]),
+        )
+        plot_cache.update(version=version, html=html, html_gz=gzip.compress(html))
+
+    if "gzip" in req.headers.get("accept-encoding", ""):
+        return func.HttpResponse(
+            plot_cache["html_gz"],
+            mimetype="text/html",
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+        )
+
+    return func.HttpResponse(
+        plot_cache["html"],
+        mimetype="text/html",
+        headers={"Vary": "Accept-Encoding"},
+    )
+
+# ================= QUEUE TRIGGER: SEND ALERT =================
+@app.queue_trigger(arg_name="msg", queue_name=ALERT_QUEUE_NAME, connection=ALERT_QUEUE_CONNECTION)
+async def send_alert(msg: func.QueueMessage) -> None:
+    alert = orjson.loads(msg.get_body())
+    await send_acs_email(alert["subject"], alert["body"])